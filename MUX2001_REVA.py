@@ -8,6 +8,7 @@ Organazation:
     Stack:  
         All cards that are dasiy-chained on the same SPI bus.
         All share common D_CLK and nMR signals.
+        nMR may also be split into one pin per group for fault isolation, all pins are checked after each write
 
     Card Group:
         Group of cards working in parallel
@@ -46,6 +47,8 @@ Organazation:
             in_n is the negative input pin
                 can be CH0 for single-ended measurements with respect to V_CH_COM
                 must be (in_p + 1) when doing 2-pole differential measurements
+            the current channel is selected with in_p = 21 and in_n = 21 (or 0)
+            any other (in_p, in_n) combination raises ValueError
         examples:
             MUX_DMM_VCC = (1, 1, 5, 0)  # group 1, card 1, channel 5 single-ended
             MUX_DMM_VCC_SHUNT = (1, 1, 5, 6)  # group 1, card 1, channel 5 to 6 differential measurement
@@ -54,28 +57,147 @@ Organazation:
             vcc_voltage = dmm.measure_vdc()
             mux.set_ch(MUX_DMM_VCC_SHUNT)
             vcc_current = dmm.measure_vdc() / 0.001
+
+            # change channels on several groups with one SPI write, one channel per group
+            mux.set_channels([(1, 1, 5, 0), (2, 3, 21, 21)])
+
+            # validate and encode a channel once, then select it by name
+            mux.register('VCC', MUX_DMM_VCC)
+            mux.set_ch_by_name('VCC')
+
+            # measure a list of channels, each result is (nMR OK, reading)
+            results = mux.scan([MUX_DMM_VCC, MUX_DMM_VCC_SHUNT], measure_fn=dmm.measure_vdc)
+
+            # do other work while R_CLK is held low, then finish the channel change
+            mux.set_ch_async(MUX_DMM_VCC)
+            dmm.configure_vdc()
+            mux.commit()
             
         
 
 """
 
+import struct
 import time
 
+# write a card's 3 SPI bytes into a buffer at a byte offset in one call
+# raises struct.error instead of growing the buffer if the offset is out of range
+_pack_ch = struct.Struct('3s').pack_into
+
+DEFAULT_RCLK_LOW_DELAY = 0.04  # seconds, minimum R_CLK low time before data is clocked in
+DEFAULT_SETTLE = 0.005  # seconds, relay close time after R_CLK rising edge
+
+# build the 3 SPI bytes for a single card channel selection
+# only used once at import to fill _SPI_ENCODING
+def _encode_ch(in_p, in_n):
+    lut = (0x80, 0x40, 0x10, 0x08, 0x04)
+    spi_data = [0, 0, 0]
+    if in_p == 21:  # current channel
+        spi_data[1] = 0x02
+
+    elif (in_p % 2 == 1) and (in_n == in_p + 1) and (1 <= in_p <= 19):   # 2-pole measurement
+        spi_data[2] = 0x10  # set AB_TO_VCOM
+        if 1 <= in_p <= 10:
+            spi_data[0] = lut[int((in_p - 1)/2)]
+        elif 11 <= in_p <= 19:
+            spi_data[1] = lut[int((in_p - 11)/2)]
+
+    elif in_n == 0 and (1 <= in_p <= 20):    # Single-ended measurement
+        if (in_p % 2) == 1:
+            spi_data[2] = 0x08  # if odd channel, select A_TO_V
+        else:
+            spi_data[2] = 0x04  # if even channel, select B_TO_V
+
+        if 1 <= in_p <= 10:
+            spi_data[0] = lut[int((in_p - 1)/2)]
+        elif 11 <= in_p <= 20:
+            spi_data[1] = lut[int((in_p - 11)/2)]
+    return bytes(spi_data)
+
+# lookup table of every legal (in_p, in_n) pair to its 3 SPI bytes
+_SPI_ENCODING = {}
+for _in_p in range(1, 21):  # single-ended measurements
+    _SPI_ENCODING[(_in_p, 0)] = _encode_ch(_in_p, 0)
+for _in_p in range(1, 20, 2):  # 2-pole differential measurements
+    _SPI_ENCODING[(_in_p, _in_p + 1)] = _encode_ch(_in_p, _in_p + 1)
+_SPI_ENCODING[(21, 21)] = _encode_ch(21, 21)  # current channel
+_SPI_ENCODING[(21, 0)] = _encode_ch(21, 0)  # current channel, in_n of 0 also accepted
+del _in_p
+
+# look up the 3 SPI bytes for a channel selection, invalid selections raise ValueError
+def _get_encoding(in_p, in_n):
+    try:
+        return _SPI_ENCODING[(in_p, in_n)]
+    except KeyError:
+        raise ValueError('Invalid channel selection in_p=%r, in_n=%r' % (in_p, in_n)) from None
+
+# build a channel select function specialized for a fixed stack layout
+# group buffers, group sizes and zero fill values are captured once instead of being looked up per call
+# group and card arguments are 0 indexed, only the selected group's SPI data is changed
+def _make_set_ch_fast(card_groups):
+    group_buffers = tuple(card_group.spi_data for card_group in card_groups)
+    group_sizes = tuple(card_group.num_cards for card_group in card_groups)
+    group_zeros = tuple(bytes(len(buf)) for buf in group_buffers)
+    num_groups = len(card_groups)
+
+    def set_ch_fast(group, card, in_p, in_n):
+        if not 0 <= group < num_groups:
+            raise ValueError('Invalid group %r' % (group + 1))
+        if not 0 <= card < group_sizes[group]:
+            raise ValueError('Invalid card %r for group %r' % (card + 1, group + 1))
+        encoding = _get_encoding(in_p, in_n)
+        buf = group_buffers[group]
+        buf[:] = group_zeros[group]  # only one channel allowed per group
+        _pack_ch(buf, 3 * card, encoding)
+
+    return set_ch_fast
+
 class MuxStack:
-    def __init__(self, read_nmr_fn, write_spi_bytes_fn):
-        self.read_nmr = read_nmr_fn  # nMR GPIO read function
-        self.write_spi_bytes = write_spi_bytes_fn  # Write SPI data bytes function
+    # rclk_low_delay is the R_CLK low time before the SPI write, the MUX2001 requires at least 40ms
+    # settle is the wait after R_CLK goes high for relays to close, recommended but not required
+    def __init__(self, read_nmr_fn, write_spi_bytes_fn, rclk_low_delay=DEFAULT_RCLK_LOW_DELAY, settle=DEFAULT_SETTLE):
+        # nMR GPIO read function
+        # can return a single state, or a tuple of states when several nMR pins are read in one transaction
+        # a list of read functions, one per nMR pin, is also accepted
+        if isinstance(read_nmr_fn, (list, tuple)):
+            read_nmr_fns = tuple(read_nmr_fn)
+            read_nmr_fn = lambda: tuple(fn() for fn in read_nmr_fns)
+        self.read_nmr = read_nmr_fn
+        # Write SPI data bytes function
+        # must block until the last byte has been clocked out, R_CLK is raised as soon as it returns
+        self.write_spi_bytes = write_spi_bytes_fn
+        self.rclk_low_delay = rclk_low_delay
+        self.settle = settle
 
         #  Create empty list of cards
         self._card_groups = []
+        self._total_bytes = 0  # total SPI bytes for all card groups
+        self._master_buffer = bytearray(self._total_bytes)  # current data for all cards, each group holds a view of its slice
+        self.spi_data = bytearray(self._total_bytes)  # SPI data bytes last written to the stack
+        self._rclk_low_deadline = None  # time R_CLK low delay expires, None while R_CLK is high
+        self._registered = {}  # named channels, name: (group index, card byte offset, SPI bytes)
+        self._set_ch_fast = _make_set_ch_fast(self._card_groups)  # rebuilt whenever the stack layout changes
         
     def add_card_group(self, num_cards, write_rclk_fn):
-        self._card_groups.append(self.MuxCardGroup(num_cards, write_rclk_fn))        
+        self._card_groups.append(MuxCardGroup(num_cards, write_rclk_fn))        
+        self._total_bytes += 3 * num_cards
+
+        # move every group onto a resized master buffer, group 1 first since it receives the first bytes written
+        master_buffer = bytearray(self._total_bytes)
+        offset = 0
+        for card_group in self._card_groups:
+            size = 3 * card_group.num_cards
+            master_buffer[offset:offset + size] = card_group.spi_data
+            card_group.bind(memoryview(master_buffer)[offset:offset + size])
+            offset += size
+        self._master_buffer = master_buffer
+
+        self.spi_data = bytearray(self._total_bytes)  # resize stack SPI buffer
+        self._set_ch_fast = _make_set_ch_fast(self._card_groups)
         
     # clear all card data and outputs
     def clear_all(self):
-        for i in range(len(self._card_groups)):  # clear each card and pack SPI buffer
-            self._card_groups[i].clear()
+        self._master_buffer[:] = bytes(self._total_bytes)  # one zero fill clears every group
         return self._write_spi()        
         
     # clear single card (group and card arguments are 1 indexed)
@@ -84,6 +206,13 @@ class MuxStack:
         self._card_groups[i].clear()
         return self._write_spi()
         
+    # read all nMR pins, returns a tuple of states (High = OK, low = FAULT)
+    def read_nmr_batch(self):
+        state = self.read_nmr()
+        if isinstance(state, (tuple, list)):
+            return tuple(state)
+        return (state,)
+
     # select output channel
     def set_ch(self, ch_tuple):
         group = ch_tuple[0] - 1
@@ -91,83 +220,176 @@ class MuxStack:
         in_p = ch_tuple[2]
         in_n = ch_tuple[3]
         
-        self._card_groups[group].set_ch(card, in_p, in_n)
+        self._set_ch_fast(group, card, in_p, in_n)
         
         self._write_spi()
-    
+
+    # register a named channel, the tuple is validated and encoded once here
+    # the group must already have been added with add_card_group()
+    def register(self, name, ch_tuple):
+        group = ch_tuple[0] - 1
+        card = ch_tuple[1] - 1
+        if not 0 <= group < len(self._card_groups):
+            raise ValueError('Invalid group %r' % ch_tuple[0])
+        if not 0 <= card < self._card_groups[group].num_cards:
+            raise ValueError('Invalid card %r for group %r' % (ch_tuple[1], ch_tuple[0]))
+        encoding = _get_encoding(ch_tuple[2], ch_tuple[3])
+
+        self._registered[name] = (group, 3 * card, encoding)
+
+    # select output channel previously registered with register()
+    def set_ch_by_name(self, name):
+        group, offset, encoding = self._registered[name]
+        card_group = self._card_groups[group]
+        card_group.clear()  # only one channel allowed per group
+        _pack_ch(card_group.spi_data, offset, encoding)
+
+        return self._write_spi()
+
+    # select output channels on several groups with a single SPI write
+    # only one channel is allowed per group, so each tuple must target a different group
+    # groups not referenced keep their current selection
+    # if any tuple is invalid, no group data is changed
+    def set_channels(self, ch_tuples):
+        saved = bytes(self._master_buffer)  # restored if a later tuple fails
+        try:
+            groups = set()
+            for ch_tuple in ch_tuples:
+                group = ch_tuple[0] - 1
+                if group in groups:
+                    raise ValueError('Only one channel allowed per group, group %i selected twice' % ch_tuple[0])
+                groups.add(group)
+
+                card = ch_tuple[1] - 1
+                in_p = ch_tuple[2]
+                in_n = ch_tuple[3]
+                self._set_ch_fast(group, card, in_p, in_n)  # update group data in memory only
+        except Exception:
+            self._master_buffer[:] = saved  # don't leave a partial batch for the next write to send
+            raise
+
+        return self._write_spi()  # one SPI write and R_CLK cycle for all channel changes
+
+    # select output channel without waiting for the R_CLK low time
+    # R_CLK is pulled low and the call returns immediately, cards are cleared until commit()
+    # the caller can do other work during the 40ms R_CLK low window, then call commit()
+    # further set_ch_async() calls before commit() keep the original R_CLK low deadline and skip the GPIO writes
+    def set_ch_async(self, ch_tuple):
+        group = ch_tuple[0] - 1
+        card = ch_tuple[1] - 1
+        in_p = ch_tuple[2]
+        in_n = ch_tuple[3]
+
+        self._set_ch_fast(group, card, in_p, in_n)
+
+        self._start_write_spi()
+
+    # finish a set_ch_async() selection
+    # sleeps only for whatever is left of the R_CLK low time, then writes SPI data and raises R_CLK
+    def commit(self):
+        if self._rclk_low_deadline is None:  # nothing pending, do a full write
+            self._start_write_spi()
+        return self._finish_write_spi()
+
+    # select output channel, then call measure_fn() once the relays have settled
+    # returns (nMR OK, reading), measure_fn() is not called and reading is None on an nMR fault
+    def set_ch_then_measure(self, ch_tuple, measure_fn):
+        self.set_ch_async(ch_tuple)
+        if not self.commit():
+            return (False, None)
+        return (True, measure_fn())
+
+    # select each channel in ch_tuples in turn and hold it for dwell seconds
+    # returns a list of (nMR OK, reading) tuples, one per channel
+    # if given, measure_fn() is called once the relays have settled, reading is None without it or on an nMR fault
+    # measure_fn() run time counts toward the dwell time
+    # channel changes can't be pipelined, pulling R_CLK low for the next channel clears the current one
+    def scan(self, ch_tuples, dwell=0, measure_fn=None):
+        results = []
+        for ch_tuple in ch_tuples:
+            self._set_ch_fast(ch_tuple[0] - 1, ch_tuple[1] - 1, ch_tuple[2], ch_tuple[3])
+            nmr_ok = self._write_spi()
+            dwell_deadline = time.perf_counter() + dwell
+            reading = None
+            if nmr_ok and measure_fn is not None:
+                reading = measure_fn()
+            results.append((nmr_ok, reading))
+            time.sleep(max(0, dwell_deadline - time.perf_counter()))
+        return results
+
     # write all cards with their current spi data
     def _write_spi(self):
-        self.spi_data = []  # clear spi data buffer
-        for i in range(len(self._card_groups)):  # clear each card group
-            self.spi_data.extend(self._card_groups[i].spi_data)
+        self._start_write_spi()
+        return self._finish_write_spi()
+
+    # first half of an SPI write, set all R_CLK signals low and start the required timing delay
+    def _start_write_spi(self):
+        if self._rclk_low_deadline is not None:  # R_CLK signals already low from set_ch_async()
+            return
+
+        for i in range(len(self._card_groups)):
             self._card_groups[i].write_rclk(0)  # set all R_CLK signals low
-            
-        time.sleep(0.04)  # required timing delay
-        self.write_spi_bytes(self.spi_data)  # write SPI data        
+
+        # timed from after the last R_CLK low returns, so every group gets the full delay
+        self._rclk_low_deadline = time.perf_counter() + self.rclk_low_delay
+
+    # second half of an SPI write, wait out the timing delay, write SPI data, and set all R_CLK signals high
+    def _finish_write_spi(self):
+        self.spi_data[:] = self._master_buffer  # snapshot current card data into the SPI buffer
+
+        time.sleep(max(0, self._rclk_low_deadline - time.perf_counter()))  # remainder of required timing delay
+        self._rclk_low_deadline = None
+        self.write_spi_bytes(self.spi_data)  # write SPI data, returns once all bytes are clocked out
         
-        for i in range(len(self._card_groups)):  # clear each card and pack SPI buffer
+        for i in range(len(self._card_groups)):
             self._card_groups[i].write_rclk(1)  # set all R_CLK signals high
         
-        time.sleep(0.005)  # give relays time to close.  Recommended, but not required
+        time.sleep(self.settle)  # give relays time to close.  Recommended, but not required
             
-        if(self.read_nmr()):  # check nMR state
-            return 1
-        else: return 0
+        return all(self.read_nmr_batch())  # True if nMR is OK, any low pin is a fault
+
+class MuxCardGroup:
+    __slots__ = ('num_cards', 'write_rclk_fn', 'spi_data', 'cards')
+
+    def __init__(self, num_cards, write_rclk_fn):
+        self.num_cards = num_cards
+        self.write_rclk_fn = write_rclk_fn
+        self.bind(bytearray(3 * num_cards))
+
+    # use spi_data (bytearray or memoryview of 3 * num_cards bytes) as the group data buffer
+    # cards write directly into their 3 byte slice
+    def bind(self, spi_data):
+        self.spi_data = spi_data
+        self.cards = []
+        for i in range(self.num_cards):
+            self.cards.append(MuxCard(self.spi_data, 3 * i))
     
-    class MuxCardGroup:
-        def __init__(self, num_cards, write_rclk_fn):
-            self.num_cards = num_cards
-            self.write_rclk_fn = write_rclk_fn
-            self.spi_data = [0] * 3 * num_cards
-            self.cards = []
-            for i in range(num_cards):
-                self.cards.append(self.MuxCard())
+    def write_rclk(self, state):
+        self.write_rclk_fn(state)
         
-        def write_rclk(self, state):
-            self.write_rclk_fn(state)
+    def clear(self):
+        self.spi_data[:] = bytes(3 * self.num_cards)  # zero fill in place, card views stay valid
             
-        def clear(self):
-            self.spi_data = []
-            for i in range(self.num_cards):
-                self.cards[i].clear()
-                self.spi_data.extend(self.cards[i].spi_data)
-                
-        def set_ch(self, card, in_p, in_n):
-            self.clear()
-            self.cards[card].set_ch(in_p, in_n)
-            self.spi_data = []
-            for i in range(self.num_cards):
-                self.spi_data.extend(self.cards[i].spi_data)
-        
-        class MuxCard:
-            def __init__(self):
-                self.spi_data = [0, 0, 0] 
-                self.lut = [0x80, 0x40, 0x10, 0x08, 0x04]
-                
-            def clear(self):
-                self.spi_data = [0, 0, 0]
-            
-            def set_ch(self, in_p, in_n):
-                self.clear()
-                if in_p == 21:  # current channel
-                    self.spi_data[1] = 0x02
-
-                elif (in_p % 2 == 1) and (in_n == in_p + 1) and (1 <= in_p <= 19):   # 2-pole measurement
-                    self.spi_data[2] = 0x10  # set AB_TO_VCOM                    
-                    if 1 <= in_p <= 10:
-                        self.spi_data[0] = self.lut[int((in_p - 1)/2)]                    
-                    elif 11 <= in_p <= 19:
-                        self.spi_data[1] = self.lut[int((in_p - 11)/2)]  
-
-                elif in_n == 0 and (1 <= in_p <= 20):    # Single-ended measurement
-                    if (in_p % 2) == 1:
-                        self.spi_data[2] = 0x08  # if odd channel, select A_TO_V
-                    else:
-                        self.spi_data[2] = 0x04  # if even channel, select B_TO_V
-
-                    if 1 <= in_p <= 10:
-                        self.spi_data[0] = self.lut[int((in_p - 1)/2)]  
-                    elif 11 <= in_p <= 20:
-                        self.spi_data[1] = self.lut[int((in_p - 11)/2)]
+    # card is 0 indexed, same checks as MuxStack channel selection
+    def set_ch(self, card, in_p, in_n):
+        if not 0 <= card < self.num_cards:
+            raise ValueError('Invalid card %r' % (card + 1))
+        encoding = _get_encoding(in_p, in_n)  # raises before any group data is changed
+        self.clear()  # only one channel allowed per group
+        _pack_ch(self.cards[card].spi_data, 0, encoding)
+
+class MuxCard:
+    __slots__ = ('spi_data',)
+
+    def __init__(self, group_spi_data, offset):
+        self.spi_data = memoryview(group_spi_data)[offset:offset + 3]  # view into parent group buffer
         
-        
\ No newline at end of file
+    def clear(self):
+        self.spi_data[:] = b'\x00\x00\x00'
+    
+    def set_ch(self, in_p, in_n):
+        _pack_ch(self.spi_data, 0, _get_encoding(in_p, in_n))  # 3 byte copy of precomputed encoding
+
+# keep the original nested class names working, MuxStack.MuxCardGroup and MuxStack.MuxCardGroup.MuxCard
+MuxStack.MuxCardGroup = MuxCardGroup
+MuxCardGroup.MuxCard = MuxCard
@@ -9,6 +9,8 @@ labjack = ljm.openS("T4", "ANY", "ANY")  # open the test labjack via any method
 info = ljm.getHandleInfo(labjack)  # get labjack connection info
 print('LabJack T%i SN%i connected\n' % (info[0], info[2]))  # print info
 
+SPI_SPEED_THROTTLE = 65500  # 100kHz SPI clock, raise toward 65535 (or 0) for a faster clock
+
 # Configure Labjack SPI and GPIO
 # https://en.wikipedia.org/wiki/Serial_Peripheral_Interface
 # CPOL = 0
@@ -19,8 +21,21 @@ ljm.eWriteName(labjack, 'SPI_CLK_DIONUM', 16)  # CIO0 as SPI CLK: D_CLK on MUX20
 ljm.eWriteName(labjack, 'SPI_MOSI_DIONUM', 17)  # CIO1 as MOSI: D_IN on MUX2001
 ljm.eWriteName(labjack, 'SPI_MODE', 0)
 ljm.eWriteName(labjack, 'SPI_OPTIONS', 1)
-ljm.eWriteName(labjack, 'SPI_SPEED_THROTTLE', 65500)  # 100kHz SPI clock
+ljm.eWriteName(labjack, 'SPI_SPEED_THROTTLE', SPI_SPEED_THROTTLE)
+
+# Look up SPI and R_CLK register addresses once so each write skips the name lookup
+SPI_NUM_BYTES_ADDR, SPI_NUM_BYTES_TYPE = ljm.nameToAddress('SPI_NUM_BYTES')
+SPI_DATA_TX_ADDR = ljm.nameToAddress('SPI_DATA_TX')[0]
+SPI_GO_ADDR, SPI_GO_TYPE = ljm.nameToAddress('SPI_GO')
+RCLK_ADDR, RCLK_TYPE = ljm.nameToAddress('CIO2')  # labjack CIO2 used as R_CLK signal
+
+# SPI_NUM_BYTES, SPI_DATA_TX and SPI_GO are written together in one Modbus feedback packet
+SPI_FRAME_ADDRS = [SPI_NUM_BYTES_ADDR, SPI_DATA_TX_ADDR, SPI_GO_ADDR]
+SPI_FRAME_TYPES = [SPI_NUM_BYTES_TYPE, ljm.constants.BYTE, SPI_GO_TYPE]
+SPI_FRAME_WRITES = [ljm.constants.WRITE] * 3
+
 
+NMR_PINS = ['CIO3']  # labjack CIO3 used as nMR input signal, add pins here for separate nMR lines per group
 
 # SPI and GPIO pin abstraction functions to pass to MUX class
 # Re-write these to adapt to Raspberry Pi or other controllers
@@ -32,7 +47,7 @@ def write_rclk_gpio(state):
     # R_CLK is used somewhat similarly to a SPI nCS signal, but does not disable data/clock inputs when high
     
     # implement your GPIO write with appropriate R_CLK pin here:
-    ljm.eWriteName(labjack, 'CIO2', bool(state))  # labjack CIO2 used as R_CLK signal
+    ljm.eWriteAddress(labjack, RCLK_ADDR, RCLK_TYPE, 1.0 if state else 0.0)  # labjack CIO2 used as R_CLK signal
     
 def read_nmr_gpio():
     # read and return nMR signal input state  
@@ -40,52 +55,43 @@ def read_nmr_gpio():
     # nMR is an open-drain signal with a weak (~100k) pullup resistor to VCC per card
     # nMR can aslo be pulled low externally to reset all MUX cards in a stack
     
-    # Implement your GPIO read with appropriate nMR pin here:
-    return ljm.eReadName(labjack, 'CIO3')  # labjack CIO3 used as nMR input signal
+    # Implement your GPIO read with appropriate nMR pin(s) here:
+    # a tuple of states may be returned when reading several nMR pins, e.g. one per card group
+    return tuple(ljm.eReadNames(labjack, len(NMR_PINS), NMR_PINS))  # all nMR pins read in one transaction
 
 def write_spi_bytes(spi_data_bytes):
-    # argument is list of SPI data bytes from MUX2001_REVA class
+    # argument is a bytearray of SPI data bytes from MUX2001_REVA class
     # implement whatever is needed to sequentially write all SPI bytes starting with element at index 0
+    # must not return until the last byte has been clocked out, R_CLK is raised right after this returns
     
     # implement your SPI write function here:
     num_bytes = len(spi_data_bytes)
-    ljm.eWriteName(labjack, 'SPI_NUM_BYTES', num_bytes)
-    ljm.eWriteNameByteArray(labjack, 'SPI_DATA_TX', num_bytes, spi_data_bytes)
-    ljm.eWriteName(labjack, 'SPI_GO', 1)
+    values = [num_bytes]
+    values.extend(spi_data_bytes)
+    values.append(1)  # SPI_GO
+    ljm.eAddresses(labjack, 3, SPI_FRAME_ADDRS, SPI_FRAME_TYPES, SPI_FRAME_WRITES, [1, num_bytes, 1], values)
     
 NUM_MUX_CARDS = 10  # define number of cards in stack
-mux = MuxStack(read_nmr_gpio, write_spi_bytes) # initialize mux stack class
+mux = MuxStack(read_nmr_gpio, write_spi_bytes, rclk_low_delay=0.04, settle=0.005) # initialize mux stack class
 mux.add_card_group(NUM_MUX_CARDS, write_rclk_gpio)  # add one group of 10 parallel cards
 mux.clear_all()  # clear all cards in all groups
 
-for card in range(10):
-    for ch in range(20):
-        mux.set_ch((1, card+1, ch+1, 0))
-        time.sleep(0.05)
+# build channel scan lists once
+single_ended = tuple((1, card, ch, 0) for card in range(1, NUM_MUX_CARDS + 1) for ch in range(1, 21))
+differential = tuple((1, card, ch, ch + 1) for card in range(1, NUM_MUX_CARDS + 1) for ch in range(1, 20, 2))
+current = tuple((1, card, 21, 21) for card in range(1, NUM_MUX_CARDS + 1))
+
+mux.scan(single_ended, dwell=0.05)
 
 mux.clear_all()
 time.sleep(0.5)
-        
-for card in range(10):
-    for ch in range(20):
-        if((ch+1) % 2 == 1):
-            mux.set_ch((1, card+1, ch+1, ch+2))
-            time.sleep(0.05)
-            
+
+mux.scan(differential, dwell=0.05)
+
 mux.clear_all()
 time.sleep(0.5)
 
-for card in range(10):
-    mux.set_ch((1, card+1, 21, 21))
-    time.sleep(0.05)
+mux.scan(current, dwell=0.05)
     
 time.sleep(0.5)
 mux.clear_all()  # clear all cards in all groups
-    
-            
-
-
-
-
-
-